@@ -0,0 +1,209 @@
+#!/usr/bin/python
+'''Stand-in for /usr/bin/lftp used by the benchmarks
+
+Serves "remote" files from a local directory instead of an SFTP server.
+Understands just enough of lftp for EWU_SFTP_2.PY:
+
+    lftp -f SCRIPT      Run the commands in SCRIPT, stopping at the first
+                        one that fails (exit code 1)
+    lftp                Read commands from stdin (batch/parallel sessions)
+
+Commands: set, open, cd, lcd, cls, get, get1, pget, put, rm, mv, echo and
+exit, chained with && and ||, plus "> FILE" redirection of cls output.
+
+Environment:
+
+    EWU_BENCH_REMOTE_ROOT       Directory that acts as the server's /
+    EWU_BENCH_CONNECT_LATENCY   Seconds to sleep on open (default 0)
+    EWU_BENCH_COMMAND_LATENCY   Seconds to sleep per remote command (default 0)
+'''
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import fnmatch
+
+REMOTE_ROOT = os.environ.get('EWU_BENCH_REMOTE_ROOT', '/tmp/ewu_bench_remote')
+CONNECT_LATENCY = float(os.environ.get('EWU_BENCH_CONNECT_LATENCY', 0) or 0)
+COMMAND_LATENCY = float(os.environ.get('EWU_BENCH_COMMAND_LATENCY', 0) or 0)
+
+REMOTE_CMDS = ('cd', 'cls', 'get', 'get1', 'pget', 'put', 'rm', 'mv')
+
+
+class CommandError(Exception): pass
+
+
+class FakeLftp(object):
+
+    def __init__(self, out):
+        self.out = out
+        self.remote_cwd = '/'
+        self.local_cwd = os.getcwd()
+        self.connected = False
+
+    def remote_path(self, path):
+        path = os.path.normpath(os.path.join(self.remote_cwd, path))
+        return os.path.join(REMOTE_ROOT, path.lstrip('/'))
+
+    def local_path(self, path):
+        return os.path.join(self.local_cwd, path)
+
+    @staticmethod
+    def _split_opts(args, with_value=('-o', '-n')):
+        opts = dict()
+        positional = list()
+        i = 0
+        while i < len(args):
+            if args[i] in with_value and i + 1 < len(args):
+                opts[args[i]] = args[i+1]
+                i += 2
+            elif args[i].startswith('-'):
+                opts[args[i]] = True
+                i += 1
+            else:
+                positional.append(args[i])
+                i += 1
+        return opts, positional
+
+    def run(self, argv, out):
+        '''Run one command.  Raises CommandError on failure'''
+        name, args = argv[0], argv[1:]
+
+        if name in REMOTE_CMDS and COMMAND_LATENCY > 0:
+            time.sleep(COMMAND_LATENCY)
+
+        if name == 'set':
+            return
+        if name == 'open':
+            if CONNECT_LATENCY > 0:
+                time.sleep(CONNECT_LATENCY)
+            self.connected = True
+            return
+        if name == 'echo':
+            out.write(' '.join(args) + "\n")
+            return
+        if name == 'lcd':
+            self.local_cwd = os.path.join(self.local_cwd, args[0])
+            return
+        if name == 'cd':
+            # The server's / is also the user's home directory
+            path = args[0]
+            if path.startswith('~'):
+                path = '/' + path[1:]
+            path = os.path.normpath(os.path.join(self.remote_cwd, path))
+            if not os.path.isdir(self.remote_path(path)):
+                raise CommandError("cd: Access failed: No such file (%s)" % (args[0]))
+            self.remote_cwd = path
+            return
+        if name == 'cls':
+            pattern = args[-1]
+            dir_path = self.remote_path('.')
+            names = sorted(fnmatch.filter(os.listdir(dir_path), pattern))
+            if len(names) == 0:
+                raise CommandError("cls: Access failed: No such file (%s)" % (pattern))
+            for filename in names:
+                st = os.stat(os.path.join(dir_path, filename))
+                out.write("%d %d %s\n" % (st.st_size, int(st.st_mtime), filename))
+            return
+        if name in ('get', 'get1', 'pget'):
+            opts, positional = self._split_opts(args)
+            src = positional[0]
+            dst = opts.get('-o', positional[1] if len(positional) > 1 else os.path.basename(src))
+            self._copy(self.remote_path(src), self.local_path(dst), opts.has_key('-c'))
+            return
+        if name == 'put':
+            opts, positional = self._split_opts(args)
+            src = positional[0]
+            dst = opts.get('-o', positional[1] if len(positional) > 1 else os.path.basename(src))
+            self._copy(self.local_path(src), self.remote_path(dst), opts.has_key('-c'))
+            return
+        if name == 'rm':
+            try:
+                os.unlink(self.remote_path(args[0]))
+            except OSError, e:
+                raise CommandError("rm: Access failed: %s" % (e.strerror))
+            return
+        if name == 'mv':
+            try:
+                os.rename(self.remote_path(args[0]), self.remote_path(args[1]))
+            except OSError, e:
+                raise CommandError("mv: Access failed: %s" % (e.strerror))
+            return
+
+        raise CommandError("Unknown command `%s'." % (name))
+
+    @staticmethod
+    def _copy(src, dst, resume):
+        # Named pipes are allowed, like lftp
+        if not os.path.exists(src) or os.path.isdir(src):
+            raise CommandError("Access failed: No such file (%s)" % (src))
+        try:
+            src_fh = open(src, 'rb')
+            if resume and os.path.exists(dst):
+                src_fh.seek(os.path.getsize(dst))
+                dst_fh = open(dst, 'ab')
+            else:
+                dst_fh = open(dst, 'wb')
+            shutil.copyfileobj(src_fh, dst_fh, 1024 * 1024)
+            src_fh.close()
+            dst_fh.close()
+        except (IOError, OSError), e:
+            raise CommandError("Access failed: %s" % (str(e)))
+
+    def run_line(self, line):
+        '''Run a line of commands chained with && and ||.  Returns success'''
+        tokens = shlex.split(line)
+        ok = True
+        op = None
+        cmd = list()
+        for token in tokens + ['&&']:
+            if token not in ('&&', '||'):
+                cmd.append(token)
+                continue
+            if len(cmd) > 0:
+                if op is None or (op == '&&' and ok) or (op == '||' and not ok):
+                    ok = self._run_redirected(cmd)
+            op = token
+            cmd = list()
+        self.out.flush()
+        return ok
+
+    def _run_redirected(self, cmd):
+        out = self.out
+        redirect = None
+        if '>' in cmd:
+            redirect = cmd[cmd.index('>') + 1]
+            cmd = cmd[:cmd.index('>')]
+            out = open(redirect, 'wt')
+        try:
+            self.run(cmd, out)
+            return True
+        except CommandError, e:
+            self.out.write(str(e) + "\n")
+            return False
+        finally:
+            if redirect is not None:
+                out.close()
+
+
+if __name__ == '__main__':
+    lftp = FakeLftp(sys.stdout)
+
+    if len(sys.argv) > 2 and sys.argv[1] == '-f':
+        fh = open(sys.argv[2], 'rt')
+        for line in fh:
+            if len(line.strip()) == 0:
+                continue
+            if not lftp.run_line(line.strip()):
+                sys.exit(1)
+        fh.close()
+        sys.exit(0)
+
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if line in ('exit', 'quit', 'bye'):
+            break
+        if len(line) > 0:
+            lftp.run_line(line)
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+'''Stand-in for /usr/bin/smbclient used by the benchmarks
+
+Serves shares from local directories instead of a Windows server.
+Understands just enough of smbclient for EWU_SMB.PY:
+
+    smbclient \\\\SERVER\\SHARE -A CREDS -c "CMD; CMD; ..."
+    smbclient \\\\SERVER\\SHARE -A CREDS        (commands from stdin)
+
+Commands: prompt, recurse, cd, lcd, ls, get, put, rm, rename and exit.  Anything else
+gets the same "command not found" reply as smbclient.
+
+Environment:
+
+    EWU_BENCH_REMOTE_ROOT       Directory holding one sub directory per share
+    EWU_BENCH_CONNECT_LATENCY   Seconds to sleep on connect (default 0)
+    EWU_BENCH_COMMAND_LATENCY   Seconds to sleep per remote command (default 0)
+'''
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import fnmatch
+
+REMOTE_ROOT = os.environ.get('EWU_BENCH_REMOTE_ROOT', '/tmp/ewu_bench_remote')
+CONNECT_LATENCY = float(os.environ.get('EWU_BENCH_CONNECT_LATENCY', 0) or 0)
+COMMAND_LATENCY = float(os.environ.get('EWU_BENCH_COMMAND_LATENCY', 0) or 0)
+
+PROMPT = 'smb: \\> '
+
+
+class FakeSmbClient(object):
+
+    def __init__(self, share, out):
+        self.share_root = os.path.join(REMOTE_ROOT, share)
+        self.cwd = ''
+        self.out = out
+        self.recurse = False
+        self.failed = False
+
+    def remote_path(self, path):
+        path = path.replace('\\', '/')
+        return os.path.normpath(os.path.join(self.share_root, self.cwd, path))
+
+    def error(self, status, detail):
+        self.out.write("%s %s\n" % (status, detail))
+        self.failed = True
+
+    def run(self, line):
+        lexer = shlex.shlex(line, posix=True)
+        lexer.whitespace_split = True
+        lexer.escape = ''           # Backslashes are path separators
+        argv = list(lexer)
+        if len(argv) == 0:
+            return
+        name, args = argv[0], argv[1:]
+
+        if name in ('cd', 'ls', 'get', 'put', 'rm', 'rename') and COMMAND_LATENCY > 0:
+            time.sleep(COMMAND_LATENCY)
+
+        if name == 'prompt':
+            return
+        if name == 'recurse':
+            self.recurse = not self.recurse
+            return
+        if name == 'cd':
+            path = args[0].replace('\\', '/')
+            if path.startswith('/'):
+                path = os.path.normpath(path.lstrip('/') or '.')
+            else:
+                path = os.path.normpath(os.path.join(self.cwd, path))
+            if not os.path.isdir(os.path.join(self.share_root, path)):
+                self.error('NT_STATUS_OBJECT_NAME_NOT_FOUND', 'cd \\%s' % (args[0]))
+                return
+            self.cwd = path
+            return
+        if name == 'lcd':
+            try:
+                os.chdir(args[0])
+            except OSError:
+                self.error('NT_STATUS_OBJECT_PATH_NOT_FOUND', 'lcd %s' % (args[0]))
+            return
+        if name == 'ls':
+            self.ls(args[0] if len(args) > 0 else '*')
+            return
+        if name == 'get':
+            src = self.remote_path(args[0])
+            dst = args[1] if len(args) > 1 else args[0]
+            if not os.path.isfile(src):
+                self.error('NT_STATUS_OBJECT_NAME_NOT_FOUND', 'opening remote file \\%s' % (args[0]))
+                return
+            shutil.copyfile(src, dst)
+            self.out.write("getting file \\%s of size %d as %s\n" % (
+                args[0], os.path.getsize(dst), dst))
+            return
+        if name == 'put':
+            src = args[0]
+            dst = self.remote_path(args[1] if len(args) > 1 else args[0])
+            if not os.path.exists(src) or os.path.isdir(src):
+                self.out.write("%s does not exist\n" % (src))
+                self.failed = True
+                return
+            # Named pipes are allowed, like smbclient
+            src_fh = open(src, 'rb')
+            dst_fh = open(dst, 'wb')
+            shutil.copyfileobj(src_fh, dst_fh, 1024 * 1024)
+            src_fh.close()
+            dst_fh.close()
+            self.out.write("putting file %s as \\%s\n" % (src, args[-1]))
+            return
+        if name == 'rename':
+            src = self.remote_path(args[0])
+            dst = self.remote_path(args[1])
+            if os.path.exists(dst):
+                self.error('NT_STATUS_OBJECT_NAME_COLLISION', 'renaming files \\%s -> \\%s' % (args[0], args[1]))
+                return
+            try:
+                os.rename(src, dst)
+            except OSError:
+                self.error('NT_STATUS_OBJECT_NAME_NOT_FOUND', 'renaming files \\%s -> \\%s' % (args[0], args[1]))
+            return
+        if name == 'rm':
+            try:
+                os.unlink(self.remote_path(args[0]))
+            except OSError:
+                self.error('NT_STATUS_NO_SUCH_FILE', 'deleting remote file \\%s' % (args[0]))
+            return
+
+        self.out.write("%s: command not found\n" % (name))
+
+    def ls(self, pattern):
+        pattern = pattern.replace('\\', '/')
+        dir_path = self.remote_path('.')
+        names = sorted(fnmatch.filter(os.listdir(dir_path), pattern))
+        if len(names) == 0:
+            self.error('NT_STATUS_NO_SUCH_FILE', 'listing \\%s' % (pattern))
+            return
+        self.out.write("\n")
+        self.ls_dir(dir_path, names)
+
+        # Like smbclient, each sub directory is headed by its path from the
+        # share root
+        if self.recurse:
+            pending = [os.path.join(dir_path, n) for n in names
+                       if os.path.isdir(os.path.join(dir_path, n))]
+            while len(pending) > 0:
+                sub_path = pending.pop(0)
+                names = sorted(os.listdir(sub_path))
+                self.out.write("\n\\%s\n" % (
+                    os.path.relpath(sub_path, self.share_root).replace('/', '\\')))
+                self.ls_dir(sub_path, [n for n in names if fnmatch.fnmatch(n, pattern)
+                                       or os.path.isdir(os.path.join(sub_path, n))])
+                pending.extend([os.path.join(sub_path, n) for n in names
+                                if os.path.isdir(os.path.join(sub_path, n))])
+
+        self.out.write("\n\t\t%d blocks of size 1024. %d blocks available\n" % (
+            1000000, 500000))
+
+    def ls_dir(self, dir_path, names):
+        for name in ['.', '..'] + names:
+            path = os.path.join(dir_path, name)
+            st = os.stat(path)
+            attrs = 'A'
+            if os.path.isdir(path):
+                attrs = 'D'
+            mtime = time.strftime('%a %b %e %H:%M:%S %Y', time.localtime(st.st_mtime))
+            self.out.write("  %-35s %2s %8d  %s\n" % (name, attrs, st.st_size, mtime))
+
+
+if __name__ == '__main__':
+    share = sys.argv[1].replace('\\', '/').strip('/').split('/')[-1]
+    cmds = None
+    if '-c' in sys.argv:
+        cmds = sys.argv[sys.argv.index('-c') + 1]
+
+    if CONNECT_LATENCY > 0:
+        time.sleep(CONNECT_LATENCY)
+
+    client = FakeSmbClient(share, sys.stdout)
+
+    if cmds is not None:
+        for cmd in cmds.split(';'):
+            client.run(cmd.strip())
+        sys.exit(1 if client.failed else 0)
+
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        sys.stdout.write(PROMPT)
+        if line in ('exit', 'quit'):
+            break
+        client.run(line)
+        sys.stdout.flush()
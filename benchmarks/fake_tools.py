@@ -0,0 +1,73 @@
+#!/usr/bin/python
+'''Stand-ins for the smaller programs the scripts call, used by the benchmarks
+
+    fake_tools.py enscript ARGS...      Reads the print job from stdin and
+                                        throws it away, like a printer that
+                                        prints instantly
+    fake_tools.py ssh-keygen ARGS...    Answers -F (nothing known) and -R
+    fake_tools.py dos2unix -v PATH      Converts line endings in place
+    fake_tools.py unix2dos -v PATH
+
+Environment:
+
+    EWU_BENCH_ENSCRIPT_OUT      If set, enscript appends a line with the
+                                bytes and pages it received to this file
+'''
+
+import os
+import sys
+import re
+
+
+def enscript(args):
+    size = 0
+    pages = 1
+    while True:
+        data = sys.stdin.read(1024 * 1024)
+        if len(data) == 0:
+            break
+        size += len(data)
+        pages += data.count(chr(12))
+    print "[ %d pages * 1 copy ] sent to printer" % (pages)
+
+    report = os.environ.get('EWU_BENCH_ENSCRIPT_OUT')
+    if report:
+        fh = open(report, 'at')
+        print >>fh, "%d %d %s" % (size, pages, ' '.join(args))
+        fh.close()
+    return 0
+
+
+def ssh_keygen(args):
+    # No keys are ever known, and removing one always works
+    return 0
+
+
+LONE_LF_PAT = re.compile(r'(?<!\r)\n')
+
+def convert(program, args):
+    path = args[-1]
+    fh = open(path, 'rb')
+    data = fh.read()
+    fh.close()
+    if program == 'dos2unix':
+        data = data.replace("\r\n", "\n")
+    else:
+        data = LONE_LF_PAT.sub("\r\n", data)
+    fh = open(path, 'wb')
+    fh.write(data)
+    fh.close()
+    print "%s: converting file %s" % (program, path)
+    return 0
+
+
+if __name__ == '__main__':
+    program, args = sys.argv[1], sys.argv[2:]
+    if program == 'enscript':
+        sys.exit(enscript(args))
+    elif program == 'ssh-keygen':
+        sys.exit(ssh_keygen(args))
+    elif program in ('dos2unix', 'unix2dos'):
+        sys.exit(convert(program, args))
+    print "fake_tools.py: unknown program " + program
+    sys.exit(2)
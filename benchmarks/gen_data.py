@@ -0,0 +1,167 @@
+#!/usr/bin/python
+'''Generate test data for the benchmarks
+
+    gen_data.py --kind=flat --dest=DIR --files=2000 --min_size=1024 --max_size=65536
+        One directory of files to transfer (EWU_SFTP_2, EWU_SMB)
+
+    gen_data.py --kind=tree --dest=DIR --files=1000000
+        Directory tree for EWU_SMART_MOVE to search.  Files are spread over
+        sub directories (--files_per_dir per directory, --fanout directories
+        per level), have .log, .txt and .dat extensions, a spread of sizes
+        and modification times, and --match_ratio of them contain the line
+        EWU_BENCH_MATCH for the content searches.
+
+    gen_data.py --kind=text --dest=FILE --size_mb=4096
+        One large report style text file (EWU_PAGE_AND_PRINT)
+
+Output is repeatable for the same --seed.
+'''
+
+import os
+import sys
+import time
+import random
+import gflags
+
+gflags.DEFINE_enum('kind', None, ['flat', 'tree', 'text'], "What to generate")
+gflags.DEFINE_string('dest', None, "Directory (flat, tree) or file (text) to create")
+gflags.DEFINE_integer('files', 1000, "Number of files (flat, tree)")
+gflags.DEFINE_integer('min_size', 512, "Smallest file in bytes (flat, tree)")
+gflags.DEFINE_integer('max_size', 8192, "Largest file in bytes (flat, tree)")
+gflags.DEFINE_integer('files_per_dir', 1000, "Files per directory (tree)")
+gflags.DEFINE_integer('fanout', 10, "Sub directories per directory (tree)")
+gflags.DEFINE_float('match_ratio', 0.01, "Fraction of files containing EWU_BENCH_MATCH (tree)")
+gflags.DEFINE_integer('max_age', 60 * 24 * 7, "Oldest modification time in minutes (tree)")
+gflags.DEFINE_integer('size_mb', 100, "Size of the text file in MB (text)")
+gflags.DEFINE_integer('max_width', 132, "Longest line in the text file (text)")
+gflags.DEFINE_integer('seed', 1, "Random seed")
+gflags.MarkFlagAsRequired('kind')
+gflags.MarkFlagAsRequired('dest')
+
+MATCH_LINE = "EWU_BENCH_MATCH\n"
+EXTENSIONS = ('.log', '.txt', '.dat')
+
+
+def make_lines(rnd, count, max_width):
+    '''Pool of report style lines to build content from'''
+    words = ['PAYROLL', 'VENDOR', 'TOTAL', 'ACCOUNT', 'CHECK', 'AMOUNT',
+             'BENEFIT', 'DEDUCTION', 'EMPLOYEE', 'BATCH', 'FUND', 'ORG']
+    lines = list()
+    for i in range(count):
+        width = rnd.randint(0, max_width)
+        parts = list()
+        length = 0
+        while length < width:
+            if rnd.random() < 0.5:
+                part = rnd.choice(words)
+            else:
+                part = "%12.2f" % (rnd.random() * 100000)
+            parts.append(part)
+            length += len(part) + 1
+        lines.append(" ".join(parts)[:width] + "\n")
+    return lines
+
+
+def make_content(rnd, lines, size):
+    content = list()
+    length = 0
+    while length < size:
+        line = rnd.choice(lines)
+        content.append(line)
+        length += len(line)
+    return "".join(content)[:size]
+
+
+def gen_flat(dest, rnd):
+    flags = gflags.FLAGS
+    lines = make_lines(rnd, 1000, 100)
+    os.makedirs(dest)
+    for i in range(flags.files):
+        size = rnd.randint(flags.min_size, flags.max_size)
+        fh = open(os.path.join(dest, "file%07d.dat" % (i)), 'wb')
+        fh.write(make_content(rnd, lines, size))
+        fh.close()
+
+
+def tree_dirs(dest, count, fanout):
+    '''Yield count directory paths, filling each level before the next'''
+    queue = [dest]
+    produced = 0
+    while produced < count:
+        parent = queue.pop(0)
+        for i in range(fanout):
+            path = os.path.join(parent, "d%03d" % (i))
+            queue.append(path)
+            yield path
+            produced += 1
+            if produced >= count:
+                return
+
+
+def gen_tree(dest, rnd):
+    flags = gflags.FLAGS
+    lines = make_lines(rnd, 1000, 100)
+    now = time.time()
+    num_dirs = max(1, (flags.files + flags.files_per_dir - 1) // flags.files_per_dir)
+    os.makedirs(dest)
+
+    dirs = [dest] + list(tree_dirs(dest, num_dirs - 1, flags.fanout))
+    file_num = 0
+    for dir_path in dirs:
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        for i in range(flags.files_per_dir):
+            if file_num >= flags.files:
+                return
+            path = os.path.join(dir_path, "f%07d%s" % (file_num, EXTENSIONS[file_num % len(EXTENSIONS)]))
+            size = rnd.randint(flags.min_size, flags.max_size)
+            content = make_content(rnd, lines, size)
+            if rnd.random() < flags.match_ratio:
+                pos = rnd.randint(0, len(content))
+                pos = content.rfind("\n", 0, pos) + 1
+                content = content[:pos] + MATCH_LINE + content[pos:]
+            fh = open(path, 'wb')
+            fh.write(content)
+            fh.close()
+            mtime = now - rnd.random() * flags.max_age * 60
+            os.utime(path, (mtime, mtime))
+            file_num += 1
+            if file_num % 100000 == 0:
+                print "%d files" % (file_num)
+
+
+def gen_text(dest, rnd):
+    flags = gflags.FLAGS
+    lines = make_lines(rnd, 5000, flags.max_width)
+    target = flags.size_mb * 1024 * 1024
+    written = 0
+    fh = open(dest, 'wb')
+    while written < target:
+        chunk = "".join([rnd.choice(lines) for i in range(10000)])
+        chunk = chunk[:target - written]
+        fh.write(chunk)
+        written += len(chunk)
+    fh.close()
+
+
+if __name__ == '__main__':
+    try:
+        argv = gflags.FLAGS(sys.argv)
+    except gflags.FlagsError, e:
+        print 'USAGE ERROR: %s\nUsage: %s ARGS\n%s' % (e, sys.argv[0], gflags.FLAGS)
+        sys.exit(1)
+    flags = gflags.FLAGS
+
+    if os.path.exists(flags.dest):
+        print "ERROR: %s already exists" % (flags.dest)
+        sys.exit(2)
+
+    rnd = random.Random(flags.seed)
+    start = time.time()
+    if flags.kind == 'flat':
+        gen_flat(flags.dest, rnd)
+    elif flags.kind == 'tree':
+        gen_tree(flags.dest, rnd)
+    elif flags.kind == 'text':
+        gen_text(flags.dest, rnd)
+    print "Generated %s %s in %.1fs" % (flags.kind, flags.dest, time.time() - start)
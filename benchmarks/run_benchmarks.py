@@ -0,0 +1,583 @@
+#!/usr/bin/python
+'''Benchmark the transfer scripts on one box, without real servers
+
+Each script is copied into a scratch directory with every /usr/bin/ program
+it calls (lftp, smbclient, enscript, ssh-keygen, dos2unix, unix2dos)
+pointed at the stand-ins in this directory.  The stand-ins serve "remote"
+files from local directories, with optional injected latency per
+connection and per command.
+
+Benchmarks:
+
+    sftp_get_m_*, sftp_put_m_*      files/sec and MB/sec for EWU_SFTP_2.PY
+    smb_get_m_*, smb_put_m_*        files/sec and MB/sec for EWU_SMB.PY
+    smart_move_*                    files scanned/sec for each EWU_SMART_MOVE
+                                    filter type
+    page_and_print*                 MB/sec and peak RSS for EWU_PAGE_AND_PRINT
+
+Results are written as JSON (--output).  Give an earlier results file with
+--compare to get a table of changes, with any metric that got worse by
+more than --threshold percent marked as a REGRESSION.
+
+Example:
+
+    python benchmarks/run_benchmarks.py --scale=small --output=before.json
+    (make changes)
+    python benchmarks/run_benchmarks.py --scale=small --compare=before.json
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import fnmatch
+import platform
+import subprocess
+import gflags
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPTS_DIR = os.path.join(REPO_DIR, 'scripts')
+
+SCALES = {
+    'small': {
+        'transfer_files':   200,
+        'transfer_max':     16 * 1024,
+        'tree_files':       10000,
+        'text_mb':          50,
+        },
+    'medium': {
+        'transfer_files':   2000,
+        'transfer_max':     64 * 1024,
+        'tree_files':       100000,
+        'text_mb':          500,
+        },
+    'large': {
+        'transfer_files':   10000,
+        'transfer_max':     256 * 1024,
+        'tree_files':       1000000,
+        'text_mb':          4096,
+        },
+    }
+
+gflags.DEFINE_enum('scale', 'small', SCALES.keys(), "Size of the generated data")
+gflags.DEFINE_string('work', '/tmp/ewu_bench', "Scratch directory.  Generated data is kept here between runs")
+gflags.DEFINE_string('only', None, "Comma separated benchmark names to run (glob patterns allowed)")
+gflags.DEFINE_integer('repeat', 1, "Run each benchmark this many times and keep the fastest run")
+gflags.DEFINE_float('connect_latency', 0.0, "Seconds added to each lftp/smbclient connection")
+gflags.DEFINE_float('command_latency', 0.0, "Seconds added to each remote lftp/smbclient command")
+gflags.DEFINE_string('python', sys.executable, "Python interpreter to run the scripts with")
+gflags.DEFINE_string('output', None, "Write results to this JSON file")
+gflags.DEFINE_string('compare', None, "Compare results to this earlier results file")
+gflags.DEFINE_float('threshold', 10.0, "Percent change that counts as a regression")
+gflags.DEFINE_bool('list', False, "List the benchmarks and exit")
+
+
+class BenchmarkError(Exception): pass
+
+
+# -- Scratch Setup ------------------------------------------------------------
+
+STAND_INS = {
+    'lftp':         ['fake_lftp.py'],
+    'smbclient':    ['fake_smbclient.py'],
+    'enscript':     ['fake_tools.py', 'enscript'],
+    'ssh-keygen':   ['fake_tools.py', 'ssh-keygen'],
+    'dos2unix':     ['fake_tools.py', 'dos2unix'],
+    'unix2dos':     ['fake_tools.py', 'unix2dos'],
+    }
+
+
+class Workspace(object):
+    '''Scratch directories, rewritten scripts and generated data'''
+
+    def __init__(self, root, scale):
+        self.root = os.path.abspath(root)
+        self.scale = scale
+        self.params = SCALES[scale]
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.scripts_dir = os.path.join(self.root, 'scripts')
+        self.home_dir = os.path.join(self.root, 'home')
+        self.data_dir = os.path.join(self.root, 'data-' + scale)
+        self.run_dir = os.path.join(self.root, 'run')
+        self.log_dir = os.path.join(self.root, 'logs')
+
+    def setup(self):
+        for path in (self.bin_dir, self.scripts_dir, self.log_dir,
+                     os.path.join(self.home_dir, '.ssh')):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        open(os.path.join(self.home_dir, '.ssh', 'known_hosts'), 'at').close()
+
+        # Stand-in programs
+        for name, cmd in STAND_INS.items():
+            path = os.path.join(self.bin_dir, name)
+            fh = open(path, 'wt')
+            print >>fh, '#!/bin/sh'
+            print >>fh, 'exec "%s" "%s" %s "$@"' % (gflags.FLAGS.python,
+                os.path.join(BENCH_DIR, cmd[0]), " ".join(cmd[1:]))
+            fh.close()
+            os.chmod(path, 0755)
+
+        # Scripts calling the stand-ins instead of /usr/bin
+        for filename in os.listdir(SCRIPTS_DIR):
+            fh = open(os.path.join(SCRIPTS_DIR, filename), 'rt')
+            source = fh.read()
+            fh.close()
+            source = source.replace('/usr/bin/', self.bin_dir + '/')
+            fh = open(os.path.join(self.scripts_dir, filename), 'wt')
+            fh.write(source)
+            fh.close()
+
+        self._generate()
+
+    def _generate(self):
+        '''Generate data for this scale unless an earlier run already did'''
+        params = self.params
+        datasets = (
+            ('flat', ['--files=%d' % (params['transfer_files']),
+                      '--min_size=%d' % (params['transfer_max'] // 4),
+                      '--max_size=%d' % (params['transfer_max'])]),
+            ('tree', ['--files=%d' % (params['tree_files'])]),
+            ('text', ['--size_mb=%d' % (params['text_mb'])]),
+            )
+        for kind, args in datasets:
+            dest = os.path.join(self.data_dir, kind)
+            if os.path.exists(dest):
+                continue
+            if not os.path.exists(self.data_dir):
+                os.makedirs(self.data_dir)
+            print "Generating %s data in %s" % (kind, dest)
+            cmd = [gflags.FLAGS.python, os.path.join(BENCH_DIR, 'gen_data.py'),
+                   '--kind=' + kind, '--dest=' + dest] + args
+            if subprocess.call(cmd) != 0:
+                if os.path.exists(dest):
+                    shutil.rmtree(dest)
+                raise BenchmarkError("Failed to generate %s data" % (kind))
+
+    def data(self, kind):
+        return os.path.join(self.data_dir, kind)
+
+    def fresh_dir(self, *parts):
+        '''Empty directory under the run directory'''
+        path = os.path.join(self.run_dir, *parts)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def write_file(self, filename, text):
+        path = os.path.join(self.run_dir, filename)
+        if not os.path.exists(self.run_dir):
+            os.makedirs(self.run_dir)
+        fh = open(path, 'wt')
+        fh.write(text)
+        fh.close()
+        return path
+
+    def run_script(self, bench_name, script, args, env=None, cwd=None):
+        '''Run a rewritten script.  Returns (seconds, peak RSS in MB, metrics)'''
+        metrics_path = os.path.join(self.run_dir, 'metrics.json')
+        if os.path.exists(metrics_path):
+            os.unlink(metrics_path)
+
+        child_env = os.environ.copy()
+        child_env['HOME'] = self.home_dir
+        child_env['EWU_METRICS_JSON'] = metrics_path
+        child_env['EWU_BENCH_CONNECT_LATENCY'] = str(gflags.FLAGS.connect_latency)
+        child_env['EWU_BENCH_COMMAND_LATENCY'] = str(gflags.FLAGS.command_latency)
+        if env is not None:
+            child_env.update(env)
+
+        log_path = os.path.join(self.log_dir, bench_name + '.log')
+        log = open(log_path, 'wt')
+        cmd = [gflags.FLAGS.python, os.path.join(self.scripts_dir, script)] + args
+        print >>log, "$> " + " ".join(cmd)
+        log.flush()
+
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                env=child_env, cwd=cwd or self.run_dir)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.time() - start
+        proc.returncode = os.WEXITSTATUS(status)
+        log.close()
+
+        if proc.returncode != 0:
+            raise BenchmarkError("%s exited with %d.  See %s" % (
+                script, proc.returncode, log_path))
+
+        metrics = None
+        if os.path.exists(metrics_path):
+            fh = open(metrics_path, 'rt')
+            metrics = json.load(fh)
+            fh.close()
+
+        return seconds, rusage.ru_maxrss / 1024.0, metrics
+
+
+def dir_stats(path):
+    '''(number of files, total bytes) directly in path'''
+    count = 0
+    size = 0
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            count += 1
+            size += os.path.getsize(file_path)
+    return count, size
+
+
+def phase_seconds(metrics, name):
+    if metrics is None:
+        return None
+    return sum([p['duration'] for p in metrics['phases'] if p['name'] == name])
+
+
+def check_upload(path, count, options):
+    '''Check that PUT_M sent every file (or one bundle of them)'''
+    if options.has_key('bundle'):
+        count = 1
+    if dir_stats(path)[0] != count:
+        raise BenchmarkError("Uploaded files don't match the source")
+
+
+def transfer_results(seconds, count, size, metrics):
+    results = {
+        'seconds':          seconds,
+        'files':            count,
+        'files_per_sec':    count / seconds,
+        'mb_per_sec':       size / seconds / (1024 * 1024),
+        }
+    if metrics is not None:
+        results['transfer_seconds'] = phase_seconds(metrics, 'transfer')
+        results['child_processes'] = metrics['counts'].get('child_processes')
+        results['connections'] = metrics['counts'].get('connections')
+    return results
+
+
+# -- Benchmarks ---------------------------------------------------------------
+
+SFTP_VARIANTS = (
+    ('serial',      {}),
+    ('batch',       {'batch': 'yes'}),
+    ('parallel4',   {'batch': 'yes', 'parallel': '4'}),
+    ('bundle',      {'batch': 'yes', 'bundle': 'tar.gz'}),
+    )
+
+def sftp_creds(ws, options):
+    text = "[bench@sftp.bench]\n"
+    text += "method = password\n"
+    text += "password = bench\n"
+    text += "server_key = ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCbench\n"
+    for key, value in sorted(options.items()):
+        text += "%s = %s\n" % (key, value)
+    return ws.write_file('sftp_creds.ini', text)
+
+
+def bench_sftp_get_m(ws, name, options):
+    creds = sftp_creds(ws, options)
+    local_dir = ws.fresh_dir('local')
+    expected = dir_stats(ws.data('flat'))
+    seconds, rss, metrics = ws.run_script(name, 'EWU_SFTP_2.PY', [
+        'sftp.bench', 'bench', 'GET_M', local_dir, '/flat/*.dat', creds,
+        'NO_DEL', 'ALL', 'OVERWRITE', 'MULTI_OK', 'OPTIONAL'],
+        env={'EWU_BENCH_REMOTE_ROOT': ws.data_dir})
+    if dir_stats(local_dir) != expected:
+        raise BenchmarkError("Downloaded files don't match the source")
+    return transfer_results(seconds, expected[0], expected[1], metrics)
+
+
+def bench_sftp_put_m(ws, name, options):
+    creds = sftp_creds(ws, options)
+    remote_root = ws.fresh_dir('remote')
+    os.makedirs(os.path.join(remote_root, 'put'))
+    expected = dir_stats(ws.data('flat'))
+    seconds, rss, metrics = ws.run_script(name, 'EWU_SFTP_2.PY', [
+        'sftp.bench', 'bench', 'PUT_M', os.path.join(ws.data('flat'), '*.dat'),
+        '/put', creds, 'NO_DEL', 'ALL', 'OVERWRITE', 'MULTI_OK', 'OPTIONAL'],
+        env={'EWU_BENCH_REMOTE_ROOT': remote_root})
+    check_upload(os.path.join(remote_root, 'put'), expected[0], options)
+    return transfer_results(seconds, expected[0], expected[1], metrics)
+
+
+SMB_VARIANTS = (
+    ('serial',          {}, 'NO_CONV'),
+    ('batch',           {'batch': 'yes'}, 'NO_CONV'),
+    ('parallel4',       {'parallel': '4'}, 'NO_CONV'),
+    ('parallel4_conv',  {'parallel': '4'}, 'CONV'),
+    ('bundle',          {'batch': 'yes', 'bundle': 'tar.gz'}, 'NO_CONV'),
+    )
+
+def smb_creds(ws, options):
+    text = "[bench@smb.bench/bench]\n"
+    text += "domain = bench.local\n"
+    text += "password = bench\n"
+    text += "echo_listing = no\n"
+    for key, value in sorted(options.items()):
+        text += "%s = %s\n" % (key, value)
+    return ws.write_file('smb_creds.ini', text)
+
+
+def bench_smb_get_m(ws, name, options, conv):
+    creds = smb_creds(ws, options)
+    local_dir = ws.fresh_dir('local')
+    share_root = ws.fresh_dir('smb_get')
+    os.symlink(ws.data_dir, os.path.join(share_root, 'bench'))
+    count, size = dir_stats(ws.data('flat'))
+    seconds, rss, metrics = ws.run_script(name, 'EWU_SMB.PY', [
+        'smb.bench', 'bench', 'GET_M', local_dir, 'bench/flat/*.dat', creds,
+        'NO_DEL', 'ALL', 'OVERWRITE', 'MULTI_OK', 'OPTIONAL', conv],
+        env={'EWU_BENCH_REMOTE_ROOT': share_root})
+    if dir_stats(local_dir)[0] != count:
+        raise BenchmarkError("Downloaded files don't match the source")
+    return transfer_results(seconds, count, size, metrics)
+
+
+def bench_smb_put_m(ws, name, options, conv):
+    creds = smb_creds(ws, options)
+    share_root = ws.fresh_dir('smb_put')
+    os.makedirs(os.path.join(share_root, 'bench', 'put'))
+    # CONV rewrites the local files, so send copies
+    local_dir = ws.fresh_dir('local')
+    for filename in os.listdir(ws.data('flat')):
+        shutil.copyfile(os.path.join(ws.data('flat'), filename),
+                        os.path.join(local_dir, filename))
+    count, size = dir_stats(local_dir)
+    seconds, rss, metrics = ws.run_script(name, 'EWU_SMB.PY', [
+        'smb.bench', 'bench', 'PUT_M', os.path.join(local_dir, '*.dat'),
+        'bench/put', creds, 'NO_DEL', 'ALL', 'OVERWRITE', 'MULTI_OK', 'OPTIONAL', conv],
+        env={'EWU_BENCH_REMOTE_ROOT': share_root})
+    check_upload(os.path.join(share_root, 'bench', 'put'), count, options)
+    return transfer_results(seconds, count, size, metrics)
+
+
+SMART_MOVE_FILTERS = (
+    ('name',            ['--filename=*.log']),
+    ('size',            ['--filename=*', '--min_size=2048', '--max_size=4096']),
+    ('age',             ['--filename=*', '--max_age=1440']),
+    ('contents',        ['--filename=*', '--search_in_file=EWU_BENCH_MATCH']),
+    ('regex',           ['--filename=*', '--search_re_in_file=^EWU_BENCH_MA[T]CH$']),
+    ('contents_workers4', ['--filename=*', '--search_in_file=EWU_BENCH_MATCH', '--workers=4']),
+    )
+
+def bench_smart_move(ws, name, filter_args):
+    out_dir = ws.fresh_dir('smart_move_out')
+    seconds, rss, metrics = ws.run_script(name, 'EWU_SMART_MOVE.py', [
+        '--search=' + ws.data('tree'), '--recurse=Y', '--action=test',
+        '--output_dir=' + out_dir] + filter_args)
+    results = {
+        'seconds':      seconds,
+        'peak_rss_mb':  rss,
+        }
+    if metrics is not None:
+        scanned = metrics['counts'].get('files_considered', 0)
+        results['files_scanned'] = scanned
+        results['files_matched'] = metrics['counts'].get('files_matched', 0)
+        results['files_per_sec'] = scanned / seconds
+    return results
+
+
+PRINTER_CONFIG = '''[defaults]
+font = Courier
+
+[bench]
+device = BENCH
+'''
+
+def bench_page_and_print(ws, name):
+    config = ws.write_file('printers.ini', PRINTER_CONFIG)
+    report = os.path.join(ws.run_dir, 'enscript.out')
+    if os.path.exists(report):
+        os.unlink(report)
+    path = ws.data('text')
+    size = os.path.getsize(path)
+    seconds, rss, metrics = ws.run_script(name, 'EWU_PAGE_AND_PRINT.PY', [
+        '--path=' + path, '--printer=bench', '--config=' + config,
+        '--orientation=landscape', '--page_num=Y', '--filename=Y'],
+        env={'EWU_BENCH_ENSCRIPT_OUT': report})
+    if not os.path.exists(report):
+        raise BenchmarkError("Nothing was sent to enscript")
+    return {
+        'seconds':      seconds,
+        'mb_per_sec':   size / seconds / (1024 * 1024),
+        'peak_rss_mb':  rss,
+        }
+
+
+def bench_page_and_print_batch(ws, name):
+    config = ws.write_file('printers.ini', PRINTER_CONFIG)
+    report = os.path.join(ws.run_dir, 'enscript.out')
+    if os.path.exists(report):
+        os.unlink(report)
+    count, size = dir_stats(ws.data('flat'))
+    seconds, rss, metrics = ws.run_script(name, 'EWU_PAGE_AND_PRINT.PY', [
+        '--glob=' + os.path.join(ws.data('flat'), '*.dat'), '--printer=bench',
+        '--config=' + config, '--orientation=landscape', '--page_num=Y',
+        '--filename=Y', '--workers=4'],
+        env={'EWU_BENCH_ENSCRIPT_OUT': report})
+    fh = open(report, 'rt')
+    jobs = len(fh.readlines())
+    fh.close()
+    return {
+        'seconds':          seconds,
+        'files_per_sec':    count / seconds,
+        'mb_per_sec':       size / seconds / (1024 * 1024),
+        'peak_rss_mb':      rss,
+        'print_jobs':       jobs,
+        }
+
+
+def list_benchmarks():
+    '''All benchmarks as (name, function, extra args)'''
+    benchmarks = list()
+    for variant, options in SFTP_VARIANTS:
+        if not options.has_key('bundle'):
+            benchmarks.append(('sftp_get_m_' + variant, bench_sftp_get_m, (options, )))
+        benchmarks.append(('sftp_put_m_' + variant, bench_sftp_put_m, (options, )))
+    for variant, options, conv in SMB_VARIANTS:
+        if not options.has_key('bundle'):
+            benchmarks.append(('smb_get_m_' + variant, bench_smb_get_m, (options, conv)))
+        benchmarks.append(('smb_put_m_' + variant, bench_smb_put_m, (options, conv)))
+    for filter_name, filter_args in SMART_MOVE_FILTERS:
+        benchmarks.append(('smart_move_' + filter_name, bench_smart_move, (filter_args, )))
+    benchmarks.append(('page_and_print', bench_page_and_print, ()))
+    benchmarks.append(('page_and_print_batch', bench_page_and_print_batch, ()))
+    return benchmarks
+
+
+# -- Report -------------------------------------------------------------------
+
+# +1: higher is better, -1: lower is better, 0: informational
+METRIC_DIRECTIONS = {
+    'files_per_sec':    1,
+    'mb_per_sec':       1,
+    'seconds':          -1,
+    'transfer_seconds': -1,
+    'peak_rss_mb':      -1,
+    'child_processes':  -1,
+    'connections':      -1,
+    }
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return "%.2f" % (value)
+    return str(value)
+
+
+def print_report(results, baseline=None, threshold=10.0):
+    '''Print results, with changes from baseline.  Returns regression count'''
+    regressions = 0
+    header = "%-28s %-18s %12s" % ('benchmark', 'metric', 'value')
+    if baseline is not None:
+        header += " %12s %9s" % ('baseline', 'change')
+    print header
+    print "-" * len(header)
+
+    for name in sorted(results.keys()):
+        result = results[name]
+        if result.has_key('error'):
+            print "%-28s ERROR: %s" % (name, result['error'])
+            continue
+        for metric in sorted(result.keys()):
+            value = result[metric]
+            line = "%-28s %-18s %12s" % (name, metric, format_value(value))
+            old = None
+            if baseline is not None:
+                old = baseline.get(name, dict()).get(metric)
+                line += " %12s" % (format_value(old))
+            if old and value is not None:
+                change = (value - old) * 100.0 / old
+                line += " %+8.1f%%" % (change)
+                direction = METRIC_DIRECTIONS.get(metric, 0)
+                if direction != 0 and change * direction < -threshold:
+                    line += "  REGRESSION"
+                    regressions += 1
+            print line
+    return regressions
+
+
+# -- Main ---------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    try:
+        argv = gflags.FLAGS(sys.argv)
+    except gflags.FlagsError, e:
+        print 'USAGE ERROR: %s\nUsage: %s ARGS\n%s' % (e, sys.argv[0], gflags.FLAGS)
+        sys.exit(1)
+    flags = gflags.FLAGS
+
+    benchmarks = list_benchmarks()
+    if flags.only is not None:
+        patterns = [p.strip() for p in flags.only.split(',') if len(p.strip()) > 0]
+        benchmarks = [b for b in benchmarks
+                      if len([p for p in patterns if fnmatch.fnmatch(b[0], p)]) > 0]
+    if flags.list:
+        for name, func, args in benchmarks:
+            print name
+        sys.exit(0)
+
+    baseline = None
+    if flags.compare is not None:
+        fh = open(flags.compare, 'rt')
+        baseline = json.load(fh)
+        fh.close()
+        for key in ('scale', 'connect_latency', 'command_latency'):
+            if baseline['meta'].get(key) != getattr(flags, key):
+                print "WARNING: Baseline was run with %s = %s" % (key, baseline['meta'].get(key))
+
+    ws = Workspace(flags.work, flags.scale)
+    try:
+        ws.setup()
+    except BenchmarkError, e:
+        print "ERROR: " + str(e)
+        sys.exit(2)
+
+    results = dict()
+    for name, func, args in benchmarks:
+        print "Running %s" % (name),
+        sys.stdout.flush()
+        best = None
+        try:
+            for i in range(flags.repeat):
+                result = func(ws, name, *args)
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            print "%.2fs" % (best['seconds'])
+        except BenchmarkError, e:
+            best = {'error': str(e)}
+            print "ERROR: " + str(e)
+        results[name] = best
+
+    output = {
+        'meta': {
+            'scale':            flags.scale,
+            'repeat':           flags.repeat,
+            'connect_latency':  flags.connect_latency,
+            'command_latency':  flags.command_latency,
+            'host':             socket.gethostname(),
+            'platform':         platform.platform(),
+            'python':           subprocess.Popen([flags.python, '-V'],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].strip(),
+            'date':             time.strftime('%Y-%m-%d %H:%M:%S'),
+            },
+        'results': results,
+        }
+    if flags.output is not None:
+        fh = open(flags.output, 'wt')
+        json.dump(output, fh, indent=2, sort_keys=True)
+        fh.close()
+        print "Results written to " + flags.output
+
+    print ""
+    regressions = print_report(results, baseline and baseline['results'], flags.threshold)
+    if regressions > 0:
+        print ""
+        print "%d metrics regressed by more than %.0f%%" % (regressions, flags.threshold)
+        sys.exit(3)
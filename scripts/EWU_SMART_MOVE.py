@@ -6,12 +6,28 @@ VERSION='1.2.0'
 import os
 import sys
 import gflags
-import subprocess
-from fnmatch import fnmatch
+import errno
+from fnmatch import translate
 from textwrap import dedent
 import re
 from time import time
 import shutil
+import json
+import fcntl
+import tempfile
+import mmap
+import multiprocessing
+import struct
+import ctypes
+import ctypes.util
+from ewu_metrics import JobMetrics, METRICS_ENV
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir     # Backport for Python 2
+    except ImportError:
+        scandir = None
 
 YES_NO_OPTS = ('Y', 'N')
 
@@ -33,6 +49,18 @@ gflags.DEFINE_enum(
     enum_values = YES_NO_OPTS,
     )
 
+gflags.DEFINE_string(
+    'max_depth',
+    default    = None,
+    help       = "How many levels of sub directories to search with --recurse=Y",
+    )
+
+gflags.DEFINE_string(
+    'exclude_dir',
+    default    = None,
+    help       = "Comma seperated glob patterns of directory names to not search",
+    )
+
 gflags.DEFINE_string(
     'filename',
     short_name = 'F',
@@ -102,6 +130,30 @@ gflags.DEFINE_string(
     help         = "Maximum number of minutes since this file was written to",
     )
 
+gflags.DEFINE_string(
+    'workers',
+    default      = None,
+    help         = "Number of processes to search file contents with (default 1)",
+    )
+
+gflags.DEFINE_string(
+    'index',
+    default      = None,
+    help         = dedent("""\
+        Path to an index file to remember files between runs.
+
+        Files that haven't changed since the last run using the same index
+        don't have their contents searched again.  May be shared by jobs.
+        """)
+    )
+
+gflags.DEFINE_enum(
+    'skip_acted',
+    default     = 'N',
+    help        = "Skip files already copied/moved to --output_dir and unchanged since.  Requires --index",
+    enum_values = YES_NO_OPTS
+    )
+
 
 
 # Output Parms
@@ -114,6 +166,16 @@ gflags.DEFINE_enum(
     enum_values = YES_NO_OPTS
     )
 
+gflags.DEFINE_string(
+    'metrics_json',
+    default      = None,
+    help         = dedent("""\
+        Write timings and counts for the run to this JSON file on exit.
+
+        Defaults to the EWU_METRICS_JSON environment variable.
+        """)
+    )
+
 
 # Processing parms
 
@@ -161,11 +223,24 @@ gflags.DEFINE_enum(
     enum_values = ['move', 'copy', 'test']
     )
 
+gflags.DEFINE_enum(
+    'watch',
+    short_name  = 'w',
+    default     = 'N',
+    help        = dedent("""\
+        Keep running and act on new files as soon as they finish being written.
+
+        Files already in the search path are acted on first.  Uses Linux
+        inotify.  Can't be used with --single_file=Y.
+        """),
+    enum_values = YES_NO_OPTS
+    )
+
 gflags.DEFINE_enum(
     'unix2dos',
     short_name  = 'u',
     default     = 'N',
-    help        = "Call unix2dos to change line endings to DOS/Windows format",
+    help        = "Change line endings to DOS/Windows format (like unix2dos) while copying",
     enum_values = YES_NO_OPTS
     )
 
@@ -181,6 +256,9 @@ def debug(msg):
     if is_yes(gflags.FLAGS.verbose):
         print msg
 
+
+METRICS = JobMetrics(VERSION, os.environ.get(METRICS_ENV) or None)
+
 ARG_PARMS=dict()
 
 
@@ -220,113 +298,660 @@ def apply_parms(subject):
     return subject
 
 
+class FileEntry(object):
+    '''A file found while searching, with its stat() looked up at most once'''
+
+    def __init__(self, path, dir_entry=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._dir_entry = dir_entry
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            if self._dir_entry is not None:
+                self._stat = self._dir_entry.stat()
+            else:
+                self._stat = os.stat(self.path)
+        return self._stat
+
+
+def _list_dir(dir_path):
+    '''List (name, path, is_dir, dir_entry) in a directory'''
+    if scandir is not None:
+        for entry in scandir(dir_path):
+            # Like os.walk, don't follow links to directories
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not entry.is_dir() and entry.is_file()
+            except OSError:
+                continue
+            if is_dir or is_file:
+                yield entry.name, entry.path, is_dir, entry
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    yield name, path, True, None
+            elif os.path.isfile(path):
+                yield name, path, False, None
+
+
 def list_files_to_consider(search_path):
-    '''List files at search path to consider'''
+    '''List files at search path to consider.  Yields FileEntry objects'''
     flags = gflags.FLAGS
 
     search_path = apply_parms(search_path)
 
-    # Return all files
+    max_depth = 0
     if is_yes(flags.recurse):
+        max_depth = flags.max_depth
         debug("Searching %s (recursivly)" % (search_path))
-        for dirpath, dirnames, filenames in os.walk(search_path):
-            for filename in filenames:
-                yield os.path.join(dirpath, filename)
     else:
         debug("Searching %s" % (search_path))
-        for filename in os.listdir(search_path):
-            path = os.path.join(search_path, filename)
-            if os.path.isfile(path):
-                yield path
 
+    exclude_pats = list()
+    if flags.exclude_dir is not None:
+        for pat in apply_parms(flags.exclude_dir).split(','):
+            if len(pat.strip()) > 0:
+                exclude_pats.append(re.compile(translate(pat.strip())))
+
+    # Walk directories with an explicit stack (path, depth)
+    pending = [(search_path, 0), ]
+    while len(pending) > 0:
+        dir_path, depth = pending.pop()
+        subdirs = list()
+        try:
+            for name, path, is_dir, dir_entry in _list_dir(dir_path):
+                if not is_dir:
+                    yield FileEntry(path, dir_entry)
+                elif max_depth is None or depth < max_depth:
+                    excluded = False
+                    for pat in exclude_pats:
+                        if pat.match(name):
+                            excluded = True
+                    if excluded:
+                        debug(path + ": skipping excluded directory")
+                    else:
+                        subdirs.append((path, depth+1))
+        except OSError, e:
+            if depth == 0:
+                raise
+            debug("Can't list %s: %s" % (dir_path, str(e)))
+
+        # Reversed so that directories are visited in listed order
+        pending.extend(reversed(subdirs))
+
+
+class ContentMatcher(object):
+    '''Searches file contents for --search_in_file and --search_re_in_file
+
+    Files are memory mapped and searched in place, so a file is never read
+    into memory as a whole.  Results are the same as searching the file one
+    line at a time: the search string or expression has to be found within a
+    single line.
+    '''
+
+    # Expression features whose meaning changes when searching a whole file
+    # instead of a single line.  Such expressions are checked line by line.
+    LINE_ONLY_RE_FEATURES = (r'\A', r'\Z', '(?=', '(?!', '(?<')
+
+    def __init__(self, search_text=None, search_re=None):
+        self.search_text = search_text
+        self.search_re = search_re
+
+        self._line_pat = None
+        self._file_pat = None
+        if search_re is not None:
+            self._line_pat = re.compile(search_re)
+            line_only = False
+            for feature in self.LINE_ONLY_RE_FEATURES:
+                if feature in search_re:
+                    line_only = True
+            if not line_only:
+                self._file_pat = re.compile(search_re, re.MULTILINE)
+
+    @property
+    def active(self):
+        return self.search_text is not None or self.search_re is not None
+
+    @property
+    def signature(self):
+        '''Identifies the search parameters in the --index'''
+        return json.dumps([self.search_text, self.search_re])
+
+    @staticmethod
+    def _line_at(data, pos):
+        '''Get the full line (with newline) that contains pos'''
+        start = data.rfind('\n', 0, pos) + 1
+        end = data.find('\n', pos)
+        if end == -1:
+            end = len(data)
+        else:
+            end += 1
+        return start, end
+
+    def _has_text(self, data):
+        text = self.search_text
+        # Text with a newline in the middle can't be on a single line
+        if '\n' in text[:-1]:
+            return False
+        return data.find(text) != -1
+
+    def _lines_match_re(self, data):
+        pos = 0
+        size = len(data)
+        while pos < size:
+            end = data.find('\n', pos)
+            if end == -1:
+                end = size
+            else:
+                end += 1
+            if self._line_pat.search(data[pos:end]):
+                return True
+            pos = end
+        return False
+
+    def _has_re(self, data):
+        if self._file_pat is None:
+            return self._lines_match_re(data)
+
+        # Search whole file for candidates, then confirm the match against
+        # just the line it was found on
+        pos = 0
+        size = len(data)
+        while pos < size:
+            m = self._file_pat.search(data, pos)
+            if m is None:
+                return False
+            # Empty match after the final newline isn't on any line
+            if m.start() == size and data[size-1] == '\n':
+                return False
+            start, end = self._line_at(data, m.start())
+            if self._line_pat.search(data[start:end]):
+                return True
+            pos = end
+        return False
+
+    def check(self, path):
+        '''Check file contents.  Returns None if matches, or reason it doesn't'''
+        fh = open(path, 'rb')
+        try:
+            size = os.fstat(fh.fileno()).st_size
+            if size == 0:
+                data = ''
+            else:
+                data = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                if self.search_text is not None:
+                    if not self._has_text(data):
+                        return "Does not have search string: " + self.search_text
+                if self.search_re is not None:
+                    if not self._has_re(data):
+                        return "Does not match expression: " + self.search_re
+                return None
+            finally:
+                if size > 0:
+                    data.close()
+        finally:
+            fh.close()
+
+
+CONTENT_MATCHER=None
 
-def check_match(path):
-    '''Check to see if a file matches the provided parameters'''
+def init_content_matcher():
+    global CONTENT_MATCHER
     flags = gflags.FLAGS
 
-    filename = os.path.basename(path)
-    check_filename = apply_parms(filename)
-    if not is_yes(flags.match_case):
-        check_filename = check_filename.lower()
+    search_text = None
+    if flags.search_in_file is not None:
+        search_text = apply_parms(flags.search_in_file)
 
-    # Check filename
-    if flags.filename is not None:
-        match_filename = apply_parms(flags.filename)
-        if not is_yes(flags.match_case):
-            match_filename = match_filename.lower()
-        if not fnmatch(check_filename, match_filename):
-            debug(path + ": no match: Does not match filename pattern " + match_filename)
-            return False
+    try:
+        CONTENT_MATCHER = ContentMatcher(search_text, flags.search_re_in_file)
+    except re.error, e:
+        print "ERROR: Invalid --search_re_in_file expression: " + str(e)
+        sys.exit(2)
 
-    # Check minimum size
-    if flags.min_size is not None:
-        if os.path.getsize(path) < flags.min_size:
-            debug(path + ": no match: File too small")
-            return False
 
-    # Check maximum size
-    if flags.max_size is not None:
-        if os.path.getsize(path) > flags.max_size:
-            debug(path + ": no match: File too big")
-            return False
+def _pool_check_contents(path):
+    '''Process pool worker.  Returns (path, reason, error)'''
+    try:
+        return path, CONTENT_MATCHER.check(path), None
+    except Exception, e:
+        return path, None, str(e)
 
-    # Check file age
-    if flags.max_age is not None:
-        stat = os.stat(path)
-        file_modified = max(int(stat.st_mtime), int(stat.st_ctime))
-        age = (time() - file_modified) / 60
-        if age > flags.max_age:
-            debug(path + ": no match: Modified %.02f minutes ago (> %d) " % (age, flags.max_age))
-            return False
 
-    # Check file contents (static search)
-    if flags.search_in_file is not None:
-        found = False
-        search_in_file = apply_parms(flags.search_in_file)
+def _pool_init(matcher):
+    global CONTENT_MATCHER
+    CONTENT_MATCHER = matcher
+
+
+class FileIndex(object):
+    '''On disk record of the files seen by previous runs (--index)
+
+    For each path the index keeps the size, mtime and ctime seen last time,
+    the content search verdicts for each set of search parameters, and
+    which destinations the file has already been copied or moved to.  A
+    file whose size, mtime and ctime haven't changed doesn't have its
+    contents searched again.
+
+    Several jobs may share an index.  Changes are merged into whatever is
+    on disk at save time while holding a lock, and the new index is written
+    to a temp file and renamed into place so readers never see half a file.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._files = dict()
+        self._changed = dict()      # path -> record, or None if removed
+
+    def _lock(self, mode):
+        fh = open(self.lock_path, 'a')
+        fcntl.flock(fh.fileno(), mode)
+        return fh
 
+    def _read(self):
+        if not os.path.exists(self.path):
+            return dict()
+        fh = open(self.path, 'rt')
         try:
-            fh = open(path, 'rt')
-            for line in fh.readlines():
-                if search_in_file in line:
-                    found = True
-                    break
+            data = json.load(fh)
+        finally:
             fh.close()
-        except Exception, e:
-            print "ERROR while searching contents of %s:" % (path)
-            print "      " + str(e)
-            sys.exit(2)
+        if data.get('version') != self.VERSION:
+            return dict()
+        return data['files']
 
-        if not found:
-            debug(path + ": no match: Does not have search string: " + search_in_file)
+    def load(self):
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            self._files = self._read()
+        finally:
+            lock.close()
+
+    # Marks text holding escaped bytes that weren't valid UTF-8.  Can't
+    # appear in a path
+    ESCAPED_MARKER = u'\0'
+
+    @classmethod
+    def _text(cls, value):
+        '''Byte string as unicode for JSON, escaping it if not valid UTF-8'''
+        if isinstance(value, unicode):
+            return value
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return cls.ESCAPED_MARKER + value.encode('string_escape').decode('ascii')
+
+    @classmethod
+    def _path(cls, key):
+        '''Path for an index key (the reverse of _text)'''
+        if key.startswith(cls.ESCAPED_MARKER):
+            return key[len(cls.ESCAPED_MARKER):].encode('ascii').decode('string_escape')
+        return key.encode('utf-8')
+
+    @classmethod
+    def _key(cls, path):
+        return cls._text(os.path.abspath(path))
+
+    @staticmethod
+    def _stat_key(entry):
+        stat = entry.stat()
+        return [stat.st_size, int(stat.st_mtime), int(stat.st_ctime)]
+
+    def _record(self, entry, create=False):
+        '''Get the record for a file, discarding it if the file changed'''
+        key = self._key(entry.path)
+        rec = self._files.get(key)
+        if rec is not None and rec['stat'] != self._stat_key(entry):
+            rec = {'stat': self._stat_key(entry),
+                   'verdicts': dict(),
+                   'acted': rec['acted']}
+            self._files[key] = rec
+            self._changed[key] = rec
+        if rec is None and create:
+            rec = {'stat': self._stat_key(entry),
+                   'verdicts': dict(),
+                   'acted': dict()}
+            self._files[key] = rec
+            self._changed[key] = rec
+        return rec
+
+    def content_verdict(self, entry, signature):
+        '''Cached result of a content search, or None if not known'''
+        rec = self._record(entry)
+        if rec is None:
+            return None
+        return rec['verdicts'].get(signature)
+
+    def set_content_verdict(self, entry, signature, verdict):
+        rec = self._record(entry, create=True)
+        rec['verdicts'][signature] = verdict
+        self._changed[self._key(entry.path)] = rec
+
+    def was_acted(self, entry, dest_key):
+        '''Has this file already been acted on as it is now?'''
+        rec = self._record(entry)
+        if rec is None:
             return False
+        return rec['acted'].get(self._text(dest_key)) == rec['stat'][:2]
+
+    def mark_acted(self, entry, dest_key):
+        rec = self._record(entry, create=True)
+        rec['acted'][self._text(dest_key)] = rec['stat'][:2]
+        self._changed[self._key(entry.path)] = rec
+
+    def forget(self, path):
+        '''Drop a file that no longer exists (moved away)'''
+        key = self._key(path)
+        if self._files.has_key(key):
+            del self._files[key]
+        self._changed[key] = None
+
+    def forget_missing(self, search_path, seen_paths):
+        '''Drop files under search_path that weren't seen and are gone'''
+        prefix = os.path.join(os.path.abspath(search_path), '')
+        seen_keys = set([self._key(p) for p in seen_paths])
+        for key in self._files.keys():
+            path = self._path(key)
+            if path.startswith(prefix) and key not in seen_keys:
+                if not os.path.exists(path):
+                    self.forget(path)
+
+    def save(self):
+        '''Merge changes into the index on disk'''
+        if len(self._changed) == 0:
+            return
+
+        lock = self._lock(fcntl.LOCK_EX)
+        try:
+            files = self._read()
+            for path, rec in self._changed.items():
+                if rec is None:
+                    if files.has_key(path):
+                        del files[path]
+                    continue
+                current = files.get(path)
+                if current is not None and current['stat'] == rec['stat']:
+                    current['verdicts'].update(rec['verdicts'])
+                    current['acted'].update(rec['acted'])
+                else:
+                    files[path] = rec
+
+            index_dir = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + '.', dir=index_dir)
+            try:
+                fh = os.fdopen(fd, 'wt')
+                json.dump({'version': self.VERSION, 'files': files}, fh)
+                fh.close()
+                os.rename(tmp_path, self.path)
+            except:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        finally:
+            lock.close()
+        self._changed = dict()
+
+
+FILE_INDEX=None
+
+def init_file_index():
+    global FILE_INDEX
+    flags = gflags.FLAGS
 
-    # Check file contents (regular expression)
-    if flags.search_re_in_file is not None:
-        found = False
-        search_re_pat = re.compile(flags.search_re_in_file)
-
+    if flags.index is not None:
+        FILE_INDEX = FileIndex(apply_parms(flags.index))
         try:
-            fh = open(path, 'rt')
-            for line in fh.readlines():
-                if search_re_pat.search(line):
-                    found = True
-                    break
-            fh.close()
+            FILE_INDEX.load()
         except Exception, e:
-            print "ERROR while searching contents of %s:" % (path)
-            print "      " + str(e)
+            print "ERROR: While reading index %s:" % (FILE_INDEX.path)
+            print "       " + str(e)
             sys.exit(2)
+    elif is_yes(flags.skip_acted):
+        print "ERROR: --skip_acted=Y requires --index"
+        sys.exit(2)
 
-        if not found:
-            debug(path + ": no match: Does not match expression: " + flags.search_re_in_file)
+
+def act_key():
+    '''Identifies where files are acted on to for --skip_acted'''
+    flags = gflags.FLAGS
+    return '%s:%s' % (flags.action, os.path.abspath(apply_parms(flags.output_dir)))
+
+
+FILENAME_PAT=None
+
+def init_filename_pat():
+    '''Compile --filename once for all the files checked'''
+    global FILENAME_PAT
+    flags = gflags.FLAGS
+
+    if flags.filename is not None:
+        match_filename = apply_parms(flags.filename)
+        if not is_yes(flags.match_case):
+            match_filename = match_filename.lower()
+        FILENAME_PAT = re.compile(translate(match_filename))
+
+
+def check_match(entry, check_contents=True):
+    '''Check to see if a file matches the provided parameters
+
+    entry may be a FileEntry or a path
+    '''
+    flags = gflags.FLAGS
+
+    if not isinstance(entry, FileEntry):
+        entry = FileEntry(entry)
+    path = entry.path
+
+    # Check filename
+    if FILENAME_PAT is not None:
+        check_filename = entry.name
+        if len(ARG_PARMS) > 0:
+            check_filename = apply_parms(check_filename)
+        if not is_yes(flags.match_case):
+            check_filename = check_filename.lower()
+        if not FILENAME_PAT.match(check_filename):
+            debug(path + ": no match: Does not match filename pattern " + flags.filename)
+            return False
+
+    try:
+        # Check minimum size
+        if flags.min_size is not None:
+            if entry.stat().st_size < flags.min_size:
+                debug(path + ": no match: File too small")
+                return False
+
+        # Check maximum size
+        if flags.max_size is not None:
+            if entry.stat().st_size > flags.max_size:
+                debug(path + ": no match: File too big")
+                return False
+
+        # Check file age
+        if flags.max_age is not None:
+            stat = entry.stat()
+            file_modified = max(int(stat.st_mtime), int(stat.st_ctime))
+            age = (time() - file_modified) / 60
+            if age > flags.max_age:
+                debug(path + ": no match: Modified %.02f minutes ago (> %d) " % (age, flags.max_age))
+                return False
+
+        # Check if already acted on in a previous run
+        if FILE_INDEX is not None and is_yes(flags.skip_acted):
+            if FILE_INDEX.was_acted(entry, act_key()):
+                debug(path + ": no match: Already acted on and not changed since")
+                return False
+
+    except OSError, e:
+        debug(path + ": no match: Can't stat file: " + str(e))
+        return False
+
+    # Check file contents
+    if check_contents and CONTENT_MATCHER.active:
+        verdict = None
+        if FILE_INDEX is not None:
+            verdict = FILE_INDEX.content_verdict(entry, CONTENT_MATCHER.signature)
+
+        if verdict is None:
+            try:
+                reason = CONTENT_MATCHER.check(path)
+            except Exception, e:
+                print "ERROR while searching contents of %s:" % (path)
+                print "      " + str(e)
+                sys.exit(2)
+            if FILE_INDEX is not None:
+                FILE_INDEX.set_content_verdict(entry, CONTENT_MATCHER.signature,
+                                               reason is None)
+        elif verdict:
+            reason = None
+        else:
+            reason = "Contents did not match in a previous run (from index)"
+
+        if reason is not None:
+            debug(path + ": no match: " + reason)
             return False
 
     # Else, matches
-    debug(path + ": MATCHES")
+    if check_contents:
+        debug(path + ": MATCHES")
     return True
 
 
-def act_on_file(path):
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Let the kernel copy file data with sendfile(2) when we can get at it
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendfile = _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+except Exception:
+    _sendfile = None
+
+
+def _plain_copy(src_fh, dst_fh):
+    '''Copy file data as is.  Uses sendfile(2) if available'''
+    if _sendfile is not None:
+        # sendfile works on the raw fds, so anything already written or
+        # read through the file objects' buffers must be accounted for
+        dst_fh.flush()
+        os.lseek(src_fh.fileno(), src_fh.tell(), os.SEEK_SET)
+        copied = 0
+        while True:
+            sent = _sendfile(dst_fh.fileno(), src_fh.fileno(), None, COPY_BUFFER_SIZE)
+            if sent == 0:
+                return
+            if sent < 0:
+                err = ctypes.get_errno()
+                if copied == 0 and err in (errno.EINVAL, errno.ENOSYS):
+                    break   # Not supported for these files.  Copy ourselves
+                raise OSError(err, os.strerror(err))
+            copied += sent
+
+    while True:
+        data = src_fh.read(COPY_BUFFER_SIZE)
+        if len(data) == 0:
+            return
+        dst_fh.write(data)
+
+
+LONE_LF_PAT = re.compile(r'(?<!\r)\n')
+
+def _unix2dos_copy(src_fh, dst_fh):
+    '''Copy file data, changing LF line endings to CRLF as it's written
+
+    Like unix2dos, lines already ending in CRLF are left alone, and files
+    that look binary (contain NUL bytes) are copied unchanged.  Returns
+    False if the file was binary.
+    '''
+    prev_cr = False
+    first = True
+    while True:
+        data = src_fh.read(COPY_BUFFER_SIZE)
+        if len(data) == 0:
+            return True
+
+        if first:
+            first = False
+            if '\0' in data:
+                dst_fh.write(data)
+                _plain_copy(src_fh, dst_fh)
+                return False
+
+        # LF at start of chunk may follow a CR at the end of the last one
+        prev_cr, was_cr = data[-1] == '\r', prev_cr
+        if data[0] == '\n':
+            if was_cr:
+                dst_fh.write('\n')
+            else:
+                dst_fh.write('\r\n')
+            data = data[1:]
+        dst_fh.write(LONE_LF_PAT.sub('\r\n', data))
+
+
+def copy_file(src_path, dst_path, unix2dos=False, keep_stat=False):
+    '''Copy a file in one pass, optionally converting line endings
+
+    Data is written to a temp file next to dst_path and renamed into place
+    once complete, so the destination never holds a partial file.
+    '''
+    dst_dir = os.path.dirname(os.path.abspath(dst_path))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.' + os.path.basename(dst_path) + '.', dir=dst_dir)
+    try:
+        dst_fh = os.fdopen(fd, 'wb')
+        try:
+            src_fh = open(src_path, 'rb')
+            try:
+                if unix2dos:
+                    if not _unix2dos_copy(src_fh, dst_fh):
+                        print "(unix2dos: skipped binary file)",
+                else:
+                    _plain_copy(src_fh, dst_fh)
+            finally:
+                src_fh.close()
+            dst_fh.flush()
+            os.fsync(dst_fh.fileno())
+        finally:
+            dst_fh.close()
+
+        if keep_stat:
+            shutil.copystat(src_path, tmp_path)
+        else:
+            shutil.copymode(src_path, tmp_path)
+        os.rename(tmp_path, dst_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def move_file(src_path, dst_path, unix2dos=False):
+    '''Move a file, copying it if it's going to a different filesystem
+
+    The source is only removed once the copy has been renamed into place.
+    '''
+    if not unix2dos:
+        try:
+            os.rename(src_path, dst_path)
+            return
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    copy_file(src_path, dst_path, unix2dos, keep_stat=True)
+    os.unlink(src_path)
+
+
+def act_on_file(path, skip_existing=False):
+    '''Act on one file.  Returns False if it was skipped'''
     flags = gflags.FLAGS
 
     dst_filename = os.path.basename(path)
@@ -337,36 +962,320 @@ def act_on_file(path):
 
     if not is_yes(flags.overwrite):
         if os.path.exists(dst_path):
+            if skip_existing:
+                print "WARNING: Destination file %s already exists.  Skipping %s" % (
+                    dst_path, path)
+                return False
             print "ERROR: Destination file %s already exists" % (dst_path)
             sys.exit(2)
 
-    if flags.action == 'test':
-        print "(test) %s -> %s" % (path, dst_path),
+    unix2dos = is_yes(flags.unix2dos)
 
-    elif flags.action == 'copy':
-        print "cp %s -> %s" % (path, dst_path), 
-        shutil.copy(path, dst_path)
-
-    elif flags.action == 'move':
-        print "mv %s -> %s" % (path, dst_path), 
-        os.rename(path, dst_path)
+    try:
+        if flags.action == 'test':
+            print "(test) %s -> %s" % (path, dst_path),
+            METRICS.file(path, 'test', os.path.getsize(path), 0.0)
+
+        elif flags.action == 'copy':
+            print "cp %s -> %s" % (path, dst_path),
+            with METRICS.timer(path, 'copy', dst_path):
+                copy_file(path, dst_path, unix2dos)
+
+        elif flags.action == 'move':
+            print "mv %s -> %s" % (path, dst_path),
+            with METRICS.timer(path, 'move', dst_path):
+                move_file(path, dst_path, unix2dos)
+
+        else:
+            print "ERROR: Unhandled action: " + flags.action
+            sys.exit(2)
 
-    else:
-        print "ERROR: Unhandled action: " + flags.action
+    except (IOError, OSError), e:
+        print ""
+        print "ERROR: Failed to %s %s to %s: %s" % (flags.action, path, dst_path, str(e))
         sys.exit(2)
 
-    # Handle unix2dos
-    if is_yes(flags.unix2dos):
+    if unix2dos:
         print " (+unix2dos)"
-        rtncode = subprocess.call(
-            ['/usr/bin/unix2dos', dst_path],
-            stdin=None,
-            stdout=None,
-            stderr=None)
-        if rtncode != 0:
-            print "ERROR: unix2dos return code %s" % (rtncode)
     else:
         print ""
+    return True
+
+
+def find_matches(search_path):
+    '''Search for matching files.  Returns (matched entries, paths seen)'''
+    flags = gflags.FLAGS
+
+    matched = list()
+    seen_paths = set()
+    if flags.workers is not None and flags.workers > 1 and CONTENT_MATCHER.active:
+        # Check names, sizes and ages here, and fan content searches out.
+        # Candidates are kept in search order (with the verdict if the index
+        # has one) so files are acted on in the same order as a serial search.
+        candidates = list()
+        for candidate in list_files_to_consider(search_path):
+            seen_paths.add(candidate.path)
+            if check_match(candidate, check_contents=False):
+                verdict = None
+                if FILE_INDEX is not None:
+                    verdict = FILE_INDEX.content_verdict(candidate, CONTENT_MATCHER.signature)
+                candidates.append((candidate, verdict))
+
+        pool = multiprocessing.Pool(flags.workers, _pool_init, (CONTENT_MATCHER, ))
+        METRICS.count('child_processes', flags.workers)
+        try:
+            # imap returns results in the order the paths were given
+            results = pool.imap(_pool_check_contents,
+                [c.path for c, verdict in candidates if verdict is None], 16)
+            for candidate, verdict in candidates:
+                if verdict is not None:
+                    if verdict:
+                        debug(candidate.path + ": MATCHES (from index)")
+                        matched.append(candidate)
+                    else:
+                        debug(candidate.path + ": no match: Contents did not match in a previous run (from index)")
+                    continue
+
+                path, reason, error = results.next()
+                if error is not None:
+                    print "ERROR while searching contents of %s:" % (path)
+                    print "      " + error
+                    pool.terminate()
+                    sys.exit(2)
+                if FILE_INDEX is not None:
+                    FILE_INDEX.set_content_verdict(candidate,
+                        CONTENT_MATCHER.signature, reason is None)
+                if reason is not None:
+                    debug(path + ": no match: " + reason)
+                else:
+                    debug(path + ": MATCHES")
+                    matched.append(candidate)
+        finally:
+            pool.terminate()
+    else:
+        for candidate in list_files_to_consider(search_path):
+            seen_paths.add(candidate.path)
+            if check_match(candidate):
+                matched.append(candidate)
+
+    METRICS.count('files_considered', len(seen_paths))
+    METRICS.count('files_matched', len(matched))
+    return matched, seen_paths
+
+
+def act_on_matches(matched, skip_existing=False):
+    '''Act on each matched file, recording it in the index'''
+    flags = gflags.FLAGS
+
+    for entry in matched:
+        if not act_on_file(entry.path, skip_existing):
+            continue
+        if FILE_INDEX is not None:
+            if flags.action == 'move':
+                FILE_INDEX.forget(entry.path)
+            elif flags.action == 'copy':
+                FILE_INDEX.mark_acted(entry, act_key())
+
+
+class DirectoryWatcher(object):
+    '''Watches --search (and sub directories with --recurse=Y) with inotify
+
+    Files are checked and acted on as soon as they are closed after being
+    written, or moved into a watched directory.  If the kernel's event
+    queue overflows, the directories are searched again to catch up.
+    '''
+
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE_SELF  = 0x00000400
+    IN_MOVE_SELF    = 0x00000800
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ONLYDIR      = 0x01000000
+    IN_ISDIR        = 0x40000000
+
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+                  | IN_MOVE_SELF | IN_ONLYDIR)
+
+    EVENT_HEADER = struct.Struct('iIII')     # wd, mask, cookie, len
+
+    def __init__(self, search_path):
+        flags = gflags.FLAGS
+        self.search_path = search_path
+        self._dirs = dict()     # wd -> (path, depth)
+        self._recent = dict()   # path -> (size, mtime) last acted on
+
+        self._max_depth = 0
+        if is_yes(flags.recurse):
+            self._max_depth = flags.max_depth
+
+        self._exclude_pats = list()
+        if flags.exclude_dir is not None:
+            for pat in apply_parms(flags.exclude_dir).split(','):
+                if len(pat.strip()) > 0:
+                    self._exclude_pats.append(re.compile(translate(pat.strip())))
+
+        # Don't react to our own output if it's under the search path
+        self._output_dir = os.path.abspath(apply_parms(flags.output_dir))
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init: " + os.strerror(err))
+
+        self._watch_tree(search_path, 0)
+
+    def _skip_dir(self, path):
+        if os.path.abspath(path) == self._output_dir:
+            return True
+        name = os.path.basename(path)
+        for pat in self._exclude_pats:
+            if pat.match(name):
+                return True
+        return False
+
+    def _watch_tree(self, dir_path, depth):
+        '''Watch a directory, and its sub directories if recursing'''
+        wd = self._add_watch(self._fd, dir_path, self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if depth == 0:
+                raise OSError(err, "Can't watch %s: %s" % (dir_path, os.strerror(err)))
+            debug("Can't watch %s: %s" % (dir_path, os.strerror(err)))
+            return
+        self._dirs[wd] = (dir_path, depth)
+        debug("Watching " + dir_path)
+
+        if self._max_depth is None or depth < self._max_depth:
+            try:
+                for name, path, is_dir, dir_entry in _list_dir(dir_path):
+                    if is_dir and not self._skip_dir(path):
+                        self._watch_tree(path, depth+1)
+            except OSError, e:
+                debug("Can't list %s: %s" % (dir_path, str(e)))
+
+    def _read_events(self):
+        '''Block until events are available.  Yields (wd, mask, name)'''
+        data = os.read(self._fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, name_len = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos:pos+name_len].rstrip('\0')
+            pos += name_len
+            yield wd, mask, name
+
+    def _rescan(self):
+        '''Catch up after missing events'''
+        print "inotify event queue overflowed.  Searching again."
+        # Directories created while events were lost aren't watched yet.
+        # Watching an already watched directory just returns its wd.
+        self._watch_tree(self.search_path, 0)
+        matched, seen_paths = find_matches(self.search_path)
+        self._act(matched)
+
+    def _version(self, entry):
+        try:
+            return (entry.stat().st_size, entry.stat().st_mtime)
+        except OSError:
+            return None
+
+    def remember(self, matched):
+        '''Record files acted on by the initial search, before acting on them
+
+        Their close events may still be queued, and must not act on them again.
+        '''
+        for entry in matched:
+            version = self._version(entry)
+            if version is not None:
+                if len(self._recent) > 10000:
+                    self._recent.clear()
+                self._recent[os.path.abspath(entry.path)] = version
+
+    def _act(self, matched):
+        '''Act on matched files, skipping versions already acted on
+
+        A file can be seen by the initial search, by a catch up search and by
+        its own events.  A destination that already exists is skipped rather
+        than stopping the watch.
+        '''
+        todo = list()
+        for entry in matched:
+            version = self._version(entry)
+            if version is None:
+                continue
+            if self._recent.get(os.path.abspath(entry.path)) == version:
+                debug(entry.path + ": already acted on")
+                continue
+            todo.append(entry)
+        self.remember(todo)
+        act_on_matches(todo, skip_existing=True)
+
+    def _check_file(self, path):
+        if os.path.dirname(os.path.abspath(path)) == self._output_dir:
+            return
+        entry = FileEntry(path)
+        if self._version(entry) is None:
+            return
+        if self._recent.get(os.path.abspath(path)) == self._version(entry):
+            return
+
+        if check_match(entry):
+            self._act([entry, ])
+
+    def run(self):
+        '''Act on files as they arrive.  Runs until killed'''
+        print ""
+        print "Watching %s for new files (%d directories)" % (
+            self.search_path, len(self._dirs))
+        sys.stdout.flush()
+
+        while True:
+            try:
+                events = list(self._read_events())
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for wd, mask, name in events:
+                if mask & self.IN_Q_OVERFLOW:
+                    self._rescan()
+                    continue
+
+                if mask & self.IN_IGNORED:
+                    if self._dirs.has_key(wd):
+                        debug("No longer watching " + self._dirs[wd][0])
+                        del self._dirs[wd]
+                    continue
+
+                if not self._dirs.has_key(wd) or len(name) == 0:
+                    continue
+                dir_path, depth = self._dirs[wd]
+                path = os.path.join(dir_path, name)
+
+                if mask & self.IN_ISDIR:
+                    # New sub directory.  Watch it, then pick up anything
+                    # written to it before the watch was in place
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        if self._max_depth is None or depth < self._max_depth:
+                            if not self._skip_dir(path):
+                                self._watch_tree(path, depth+1)
+                                for entry in list_files_to_consider(path):
+                                    self._check_file(entry.path)
+
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    if os.path.isfile(path):
+                        self._check_file(path)
+
+            if FILE_INDEX is not None:
+                FILE_INDEX.save()
+            METRICS.save()
+            sys.stdout.flush()
 
 
 if __name__ == '__main__':
@@ -377,6 +1286,7 @@ if __name__ == '__main__':
 
 
     # Parse command line arguments
+    METRICS.phase('arguments')
     try:
         argv = gflags.FLAGS(sys.argv)
     except gflags.FlagsError, e:
@@ -389,6 +1299,10 @@ if __name__ == '__main__':
         flags.search = None
     if len(str(flags.recurse).strip()) == 0:
         flags.recurse = None
+    if len(str(flags.max_depth).strip()) == 0:
+        flags.max_depth = None
+    if len(str(flags.exclude_dir).strip()) == 0:
+        flags.exclude_dir = None
     if len(str(flags.filename).strip()) == 0:
         flags.filename = None
     if len(str(flags.match_case).strip()) == 0:
@@ -405,6 +1319,12 @@ if __name__ == '__main__':
         flags.search_re_in_file = None
     if len(str(flags.max_age).strip()) == 0:
         flags.max_age = None
+    if len(str(flags.workers).strip()) == 0:
+        flags.workers = None
+    if len(str(flags.index).strip()) == 0:
+        flags.index = None
+    if len(str(flags.skip_acted).strip()) == 0:
+        flags.skip_acted = None
     if len(str(flags.verbose).strip()) == 0:
         flags.verbose = None
     if len(str(flags.output_dir).strip()) == 0:
@@ -421,6 +1341,13 @@ if __name__ == '__main__':
         flags.action = None
     if len(str(flags.unix2dos).strip()) == 0:
         flags.unix2dos = None
+    if len(str(flags.watch).strip()) == 0:
+        flags.watch = None
+    if len(str(flags.metrics_json).strip()) == 0:
+        flags.metrics_json = None
+
+    if flags.metrics_json is not None:
+        METRICS.path = flags.metrics_json
 
     # Re-apply defaults (UC4 passes '--flag=' if not value provided)
     flags.recurse = flags.recurse or 'N'
@@ -430,6 +1357,12 @@ if __name__ == '__main__':
     flags.overwrite = flags.overwrite or 'N'
     flags.must_match = flags.must_match or 'N'
     flags.unix2dos = flags.unix2dos or 'N'
+    flags.skip_acted = flags.skip_acted or 'N'
+    flags.watch = flags.watch or 'N'
+
+    if is_yes(flags.watch) and is_yes(flags.single_file):
+        print "ERROR: --watch=Y can't be used with --single_file=Y"
+        sys.exit(1)
 
     # Convert flags to ints
     if flags.min_size is not None:
@@ -438,9 +1371,16 @@ if __name__ == '__main__':
         flags.max_size = int(flags.max_size)
     if flags.max_age is not None:
         flags.max_age = int(flags.max_age)
+    if flags.workers is not None:
+        flags.workers = int(flags.workers)
+    if flags.max_depth is not None:
+        flags.max_depth = int(flags.max_depth)
 
     # Load replacement patterns
     load_parms()
+    init_filename_pat()
+    init_content_matcher()
+    init_file_index()
 
     # Determine search path
     search_path = flags.search
@@ -457,26 +1397,42 @@ if __name__ == '__main__':
         print "ERROR: Search path is not a directory: " + search_path
         sys.exit(1)
 
+    # Start watching before the initial search so nothing is missed
+    watcher = None
+    if is_yes(flags.watch):
+        watcher = DirectoryWatcher(apply_parms(search_path))
+
+    METRICS.set('search', search_path)
+    METRICS.set('output_dir', flags.output_dir)
+    METRICS.set('action', flags.action)
+
     # Find files to act on
-    matched = list()
-    for candidate in list_files_to_consider(search_path):
-        if check_match(candidate):
-            matched.append(candidate)
+    METRICS.phase('search')
+    matched, seen_paths = find_matches(search_path)
 
     # Check matches
     if is_yes(flags.single_file) and len(matched) > 1:
         print "ERROR: Multiple files matched:"
-        for path in matched:
-            print " - " + path
+        for entry in matched:
+            print " - " + entry.path
         sys.exit(2)
 
-    if is_yes(flags.must_match) and len(matched) < 1:
+    if is_yes(flags.must_match) and len(matched) < 1 and watcher is None:
         print "ERROR: No files found"
         sys.exit(2)
 
     # Act on files
-    for path in matched:
-        act_on_file(path)
+    METRICS.phase('act')
+    if watcher is not None:
+        watcher.remember(matched)
+    try:
+        act_on_matches(matched)
+
+    # Remember what we found for next time (even if we stopped on an error)
+    finally:
+        if FILE_INDEX is not None:
+            FILE_INDEX.forget_missing(apply_parms(search_path), seen_paths)
+            FILE_INDEX.save()
 
     print ""
     if len(matched) == 1:
@@ -484,3 +1440,10 @@ if __name__ == '__main__':
     else:    
         print "Acted on %d files" % (len(matched))
 
+    # Keep acting on new files as they arrive
+    if watcher is not None:
+        METRICS.phase('watch')
+        watcher.run()
+
+    METRICS.save('finished')
+
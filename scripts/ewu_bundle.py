@@ -0,0 +1,283 @@
+'''Bundles shared by EWU_SFTP_2.PY and EWU_SMB.PY
+
+Writes many files as one tar or zip archive with a manifest of their names,
+sizes and sha256 checksums, and extracts and verifies such archives.  Copy
+this file into the same directory as the scripts.
+'''
+
+import os
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import threading
+from StringIO import StringIO
+
+
+BUNDLE_FORMATS = {
+    # format: (extension, tarfile mode)
+    'tar':      ('.tar',        'w|'),
+    'tar.gz':   ('.tar.gz',     'w|gz'),
+    'tar.bz2':  ('.tar.bz2',    'w|bz2'),
+    'zip':      ('.zip',        None),
+    }
+BUNDLE_MANIFEST_NAME = 'EWU_BUNDLE_MANIFEST.txt'
+
+class BundleError(Exception): pass
+
+
+class _CountingWriter(object):
+    '''Counts bytes written, so zipfile can write to a pipe'''
+    def __init__(self, fh):
+        self._fh = fh
+        self.size = 0
+
+    def write(self, data):
+        self._fh.write(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self._fh.flush()
+
+
+class _HashingReader(object):
+    '''Checksums and counts bytes as tarfile reads them'''
+    def __init__(self, fh):
+        self._fh = fh
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+
+def format_bundle_manifest(manifest):
+    lines = ["# name\tsize\tsha256"]
+    for name, size, checksum in manifest:
+        lines.append("%s\t%d\t%s" % (name, size, checksum))
+    return "\n".join(lines) + "\n"
+
+
+def parse_bundle_manifest(text):
+    '''Manifest text as dict of name: (size, sha256)'''
+    manifest = dict()
+    for line in text.split("\n"):
+        if len(line.strip()) == 0 or line.startswith('#'):
+            continue
+        try:
+            name, size, checksum = line.rstrip("\r").split("\t")
+            manifest[name] = (int(size), checksum)
+        except ValueError:
+            raise BundleError("Invalid line in bundle manifest: " + line)
+    return manifest
+
+
+def write_bundle(fh, bundle_format, dir_path, filenames):
+    '''Write files from dir_path to fh as one archive, in a single pass
+
+    Each file is checksummed as it is added, and a manifest of names, sizes
+    and sha256 checksums is added as the last member.  fh only needs to be
+    writable, so it can be a pipe.  zip members are built in memory, so
+    zip suits small files best.
+
+    Returns (manifest as (name, size, sha256) list, bytes written)
+    '''
+    out = _CountingWriter(fh)
+    manifest = list()
+
+    if bundle_format == 'zip':
+        archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, True)
+        try:
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                stat = os.stat(path)
+                src = open(path, 'rb')
+                try:
+                    data = src.read()
+                finally:
+                    src.close()
+                info = zipfile.ZipInfo(filename, time.localtime(stat.st_mtime)[:6])
+                info.external_attr = (stat.st_mode & 0xFFFF) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, data)
+                manifest.append((filename, len(data), hashlib.sha256(data).hexdigest()))
+            archive.writestr(BUNDLE_MANIFEST_NAME, format_bundle_manifest(manifest))
+            archive.close()
+        except:
+            archive.fp = None       # Don't write the directory on cleanup
+            raise
+
+    else:
+        archive = tarfile.open(fileobj=out, mode=BUNDLE_FORMATS[bundle_format][1])
+        try:
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                src = open(path, 'rb')
+                try:
+                    info = archive.gettarinfo(path, filename, src)
+                    reader = _HashingReader(src)
+                    archive.addfile(info, reader)
+                finally:
+                    src.close()
+                manifest.append((filename, reader.size, reader.digest.hexdigest()))
+            text = format_bundle_manifest(manifest)
+            info = tarfile.TarInfo(BUNDLE_MANIFEST_NAME)
+            info.size = len(text)
+            info.mtime = int(time.time())
+            info.mode = 0644
+            archive.addfile(info, StringIO(text))
+            archive.close()
+        except:
+            archive.fileobj.closed = True   # Don't flush the stream on cleanup
+            raise
+
+    out.flush()
+    return manifest, out.size
+
+
+class BundleWriter(threading.Thread):
+    '''Writes a bundle to path for the upload to read from
+
+    Normally path is a named pipe and the writer runs as a thread alongside
+    the upload, so the bundle is never stored on disk.  With spool=True,
+    path is a regular file: call run() to write the whole bundle before the
+    upload starts, for clients that can't read from a pipe.  Either way,
+    call release() once the upload is over, whether it worked or not.
+    '''
+
+    def __init__(self, path, bundle_format, dir_path, filenames, spool=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self._args = (bundle_format, dir_path, filenames)
+        self.manifest = None
+        self.size = None
+        self.error = None
+        if not spool:
+            os.mkfifo(path, 0600)
+
+    def run(self):
+        try:
+            fh = open(self.path, 'wb')
+            try:
+                self.manifest, self.size = write_bundle(fh, *self._args)
+            finally:
+                fh.close()
+        except Exception, e:
+            self.error = str(e)
+
+    def release(self):
+        '''Wait for the writer, unblocking it if the upload stopped reading'''
+        while self.is_alive():
+            # Opening the read end lets a writer blocked in open() through.
+            # Once closed, its writes fail instead of blocking.
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+            self.join(0.1)
+        if self.error is None and self.manifest is None:
+            self.error = "Upload stopped before the bundle was complete"
+
+
+def _bundle_members(archive):
+    '''(name, kind, open function) for each member of a tar or zip archive'''
+    members = list()
+    if isinstance(archive, zipfile.ZipFile):
+        for info in archive.infolist():
+            kind = 'file'
+            if info.filename.endswith('/'):
+                kind = 'dir'
+            elif (info.external_attr >> 16) & 0170000 not in (0, 0100000):
+                kind = 'other'      # Symlinks and such, from unix zips
+            members.append((info.filename, kind,
+                            lambda info=info: archive.open(info)))
+    else:
+        for info in archive.getmembers():
+            kind = 'other'
+            if info.isdir():
+                kind = 'dir'
+            elif info.isfile():
+                kind = 'file'
+            members.append((info.name, kind,
+                            lambda info=info: archive.extractfile(info)))
+    return members
+
+
+def extract_bundle(path, dest_dir, overwrite):
+    '''Extract a tar or zip bundle into dest_dir.  Returns files extracted
+
+    Every member must be a plain file or directory inside dest_dir.  If the
+    bundle has a manifest, each file in it must be extracted with the size
+    and sha256 checksum recorded.  The manifest itself is not extracted.
+    '''
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path, 'r')
+    elif tarfile.is_tarfile(path):
+        archive = tarfile.open(path, 'r:*')
+    else:
+        raise BundleError("%s is not a tar or zip file" % (path))
+
+    try:
+        members = _bundle_members(archive)
+
+        # Check everything before writing anything
+        manifest = None
+        for name, kind, open_member in members:
+            norm = os.path.normpath(name)
+            if os.path.isabs(name) or norm == '..' or norm.startswith('..' + os.sep):
+                raise BundleError("Bundle member %s is outside the target directory" % (name))
+            if kind == 'other':
+                raise BundleError("Bundle member %s is not a file or directory" % (name))
+            if kind == 'file' and norm == BUNDLE_MANIFEST_NAME:
+                fh = open_member()
+                try:
+                    manifest = parse_bundle_manifest(fh.read())
+                finally:
+                    fh.close()
+            elif kind == 'file' and overwrite == 'ERROR_EXISTING':
+                if os.path.exists(os.path.join(dest_dir, norm)):
+                    msg = "File already exists on local host: "
+                    raise BundleError(msg + os.path.join(dest_dir, norm))
+
+        # Extract
+        extracted = dict()
+        for name, kind, open_member in members:
+            norm = os.path.normpath(name)
+            target = os.path.join(dest_dir, norm)
+            if kind == 'dir':
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if norm == BUNDLE_MANIFEST_NAME:
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            src = open_member()
+            dst = open(target, 'wb')
+            try:
+                reader = _HashingReader(src)
+                shutil.copyfileobj(reader, dst, 1024 * 1024)
+            finally:
+                dst.close()
+                src.close()
+            extracted[norm] = (reader.size, reader.digest.hexdigest())
+    finally:
+        archive.close()
+
+    # Verify against the manifest
+    if manifest is not None:
+        for name, expected in sorted(manifest.items()):
+            actual = extracted.get(os.path.normpath(name))
+            if actual is None:
+                raise BundleError("%s is in the bundle manifest but not the bundle" % (name))
+            if actual != expected:
+                msg = "%s doesn't match the bundle manifest (%d bytes, sha256 %s)"
+                raise BundleError(msg % (name, expected[0], expected[1]))
+
+    return sorted(extracted.keys())
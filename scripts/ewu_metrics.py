@@ -0,0 +1,165 @@
+'''Job metrics shared by EWU_SFTP_2.PY, EWU_SMB.PY and EWU_SMART_MOVE.py
+
+Copy this file into the same directory as the scripts.
+'''
+
+import os
+import sys
+import time
+import json
+import threading
+import atexit
+
+
+METRICS_ENV='EWU_METRICS_JSON'
+
+class JobMetrics(object):
+    '''Machine readable timings and counts for one run of the script
+
+    Nothing is recorded unless a path is given (the scripts default it to
+    the EWU_METRICS_JSON environment variable).  The JSON file holds the time
+    spent in each phase of the job, an entry per file acted on (bytes,
+    seconds, bytes per second) with totals per action, and counts of child
+    processes started and connections opened.
+    '''
+
+    MAX_FILES=10000     # Per file entries kept.  Totals still count the rest
+
+    def __init__(self, version, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._phase = None
+        self._finalized = False
+        self.data = {
+            'script':       os.path.basename(sys.argv[0]),
+            'version':      version,
+            'pid':          os.getpid(),
+            'started':      time.time(),
+            'finished':     None,
+            'duration':     None,
+            'status':       'running',
+            'job':          dict(),
+            'phases':       list(),
+            'files':        list(),
+            'actions':      dict(),
+            'counts':       {'child_processes': 0, 'connections': 0},
+            }
+        atexit.register(self._at_exit)
+
+    def set(self, key, value):
+        '''Record a detail about the job (mode, host, ...)'''
+        self.data['job'][key] = value
+
+    def phase(self, name):
+        '''Start timing a new phase of the job, ending the current one'''
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._end_phase(now)
+            self._phase = (name, now)
+        finally:
+            self._lock.release()
+
+    def _end_phase(self, now):
+        if self._phase is not None:
+            name, start = self._phase
+            self.data['phases'].append({
+                'name':     name,
+                'start':    start,
+                'duration': now - start,
+                })
+            self._phase = None
+
+    def count(self, name, n=1):
+        '''Add to a counter (child_processes, connections, ...)'''
+        self._lock.acquire()
+        try:
+            self.data['counts'][name] = self.data['counts'].get(name, 0) + n
+        finally:
+            self._lock.release()
+
+    def file(self, name, action, size, duration, ok=True):
+        '''Record one file acted on.  size in bytes (or None), duration in seconds'''
+        rate = None
+        if size is not None and duration > 0:
+            rate = size / duration
+        self._lock.acquire()
+        try:
+            if len(self.data['files']) < self.MAX_FILES:
+                self.data['files'].append({
+                    'name':             name,
+                    'action':           action,
+                    'ok':               ok,
+                    'bytes':            size,
+                    'duration':         duration,
+                    'bytes_per_sec':    rate,
+                    })
+            totals = self.data['actions'].setdefault(action,
+                {'files': 0, 'failed': 0, 'bytes': 0, 'duration': 0.0})
+            totals['files'] += 1
+            if not ok:
+                totals['failed'] += 1
+            totals['bytes'] += size or 0
+            totals['duration'] += duration
+        finally:
+            self._lock.release()
+
+    def timer(self, name, action, path=None, size=None):
+        '''Context manager that records one file action when the block ends
+
+        The size is read from path at the end of the block if given.  The
+        action counts as failed if the block raises.
+        '''
+        return _FileTimer(self, name, action, path, size)
+
+    def save(self, status='running'):
+        '''Write the metrics file.  Any status other than running ends the job'''
+        if self.path is None or self._finalized:
+            return
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self.data['status'] = status
+            if status != 'running':
+                self._end_phase(now)
+                self._finalized = True
+            self.data['finished'] = now
+            self.data['duration'] = now - self.data['started']
+            try:
+                tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+                fh = open(tmp_path, 'wt')
+                try:
+                    json.dump(self.data, fh, indent=2, sort_keys=True)
+                finally:
+                    fh.close()
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError), e:
+                print "WARNING: Failed to write metrics to %s: %s" % (self.path, str(e))
+        finally:
+            self._lock.release()
+
+    def _at_exit(self):
+        # Exited some other way than finishing or abort()
+        self.save('incomplete')
+
+
+class _FileTimer(object):
+    def __init__(self, metrics, name, action, path, size):
+        self._metrics = metrics
+        self._name = name
+        self._action = action
+        self._path = path
+        self._size = size
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self._start
+        size = self._size
+        if self._path is not None and os.path.isfile(self._path):
+            size = os.path.getsize(self._path)
+        self._metrics.file(self._name, self._action, size, duration,
+                           ok=exc_type is None)
+        return False